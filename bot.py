@@ -1,34 +1,61 @@
 
 import asyncio
 import logging
-from typing import Optional
-from unittest.mock import patch
+import sys
+from collections import OrderedDict
+from typing import List, Optional
 
 from aiogram import Bot, Dispatcher
-from aiogram.types import Message, Update, MessageEntityType, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import (
+    Message, MessageEntity, Update, MessageEntityType, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+)
 from aiogram.utils import markdown
 from aiogram.utils.exceptions import CantParseEntities, MessageNotModified
-from aiogram.utils.markdown import text, code, escape_md, quote_html, pre, LIST_MD_SYMBOLS
+from aiogram.utils.markdown import text, code, LIST_MD_SYMBOLS
 
 import config
 
 logger = logging.getLogger('bot')
 
-bot = Bot(token=config.BOT_TOKEN)
+# One pooled aiohttp session for all API calls; a bigger connection limit
+# lets concurrent handlers reuse warm connections instead of queueing
+bot = Bot(token=config.BOT_TOKEN, connections_limit=100)
 dp = Dispatcher(bot=bot)
 
-SHOW_RAW_MD = 'Markdown'
-SHOW_RAW_HTML = 'HTML'
-SHOW_FORMATTED = 'Markup'
+SHOW_RAW_MD = sys.intern('Markdown')
+SHOW_RAW_HTML = sys.intern('HTML')
+SHOW_FORMATTED = sys.intern('Markup')
+
+# aiogram evaluates the callback filter on every callback update;
+# a frozenset of interned strings keeps that to a single hashed lookup
+MODIFY_CALLBACKS = frozenset((SHOW_RAW_MD, SHOW_RAW_HTML, SHOW_FORMATTED))
+
+
+class ConstantMarkup(InlineKeyboardMarkup):
+    """
+    Inline keyboard that is built once and never modified,
+    so it serializes once too
+
+    aiogram calls `to_python()` on the markup for every request payload;
+    for the two module-level keyboards below that rebuilds
+    the same dict on each message
+    """
+
+    def to_python(self) -> dict:
+        cached = getattr(self, '_cached_python', None)
+        if cached is None:
+            cached = self._cached_python = super().to_python()
+        return cached
 
-SHOW_RAW_MARKUP = InlineKeyboardMarkup(
+
+SHOW_RAW_MARKUP = ConstantMarkup(
     inline_keyboard=[[
         InlineKeyboardButton(text=SHOW_RAW_MD, callback_data=SHOW_RAW_MD),
         InlineKeyboardButton(text=SHOW_RAW_HTML, callback_data=SHOW_RAW_HTML)
     ]]
 )
 
-SHOW_FORMATTED_MARKUP = InlineKeyboardMarkup(inline_keyboard=[[
+SHOW_FORMATTED_MARKUP = ConstantMarkup(inline_keyboard=[[
     InlineKeyboardButton(text=SHOW_FORMATTED, callback_data=SHOW_FORMATTED)
 ]])
 
@@ -51,18 +78,54 @@ GREETING = text(
     sep='\n'
 )
 
-# Dirty hack to avoid aiogram escape existing symbols and modifying plain urls
-# TODO: PR for this maybe?
-dont_escape_md = patch('aiogram.utils.markdown.escape_md', new=lambda s: s)
-dont_change_plain_urls = patch.object(MessageEntityType, 'URL', new='NOT URL')
+class _PlainURLsUntouched:
+    """
+    Dirty hack to avoid aiogram modifying plain urls:
+    swaps `MessageEntityType.URL` for a value no entity matches,
+    so plain urls render as-is
+
+    Does the same as `mock.patch.object(MessageEntityType, 'URL', ...)`,
+    but without rebuilding the patch machinery on every enter/exit —
+    this runs on every inbound message
+
+    TODO: PR for this maybe?
+    """
+
+    __slots__ = ('_original',)
+
+    def __enter__(self):
+        self._original = MessageEntityType.URL
+        MessageEntityType.URL = 'NOT URL'
+
+    def __exit__(self, *exc_info):
+        MessageEntityType.URL = self._original
+
+
+dont_change_plain_urls = _PlainURLsUntouched()
 
 # Remove '\n' before closing ``` in markdown
 # Otherwise newlines will grow on each parsing
-markdown.MD_SYMBOLS = (
-        markdown.MD_SYMBOLS[:3] + ((LIST_MD_SYMBOLS[2] * 3 + '\n', LIST_MD_SYMBOLS[2] * 3),) + markdown.MD_SYMBOLS[4:]
+PRE_OPEN = sys.intern(LIST_MD_SYMBOLS[2] * 3 + '\n')
+PRE_CLOSE = sys.intern(LIST_MD_SYMBOLS[2] * 3)
+
+markdown.MD_SYMBOLS = tuple(
+    tuple(map(sys.intern, symbols))
+    for symbols in markdown.MD_SYMBOLS[:3] + ((PRE_OPEN, PRE_CLOSE),) + markdown.MD_SYMBOLS[4:]
 )
 
 
+def fast_pre(content: str) -> str:
+    """
+    `markdown.pre` for a single ready-made string:
+    wraps it in the patched pre symbols without the join indirection
+    """
+
+    return f'{PRE_OPEN}{content}{PRE_CLOSE}'
+
+
+_NEWLINE_TO_SPACE = str.maketrans('\n', ' ')
+
+
 def get_error_caption(bad_text: str, exc_message: str):
     """
     :param bad_text: text with improper formatting
@@ -74,8 +137,11 @@ def get_error_caption(bad_text: str, exc_message: str):
     try:
         _, offset = exc_message.rsplit('offset', maxsplit=1)
         offset = int(offset.strip())
-        encoded = bad_text.encode()
-        offset = len(encoded[:offset].decode())
+        # Telegram reports utf-8 byte offsets; every char starts with
+        # a lead byte, so counting them in the prefix gives the char offset
+        # without slicing and decoding a copy of the text
+        prefix = memoryview(bad_text.encode())[:offset]
+        offset = sum(byte & 0xC0 != 0x80 for byte in prefix)
         exc_message += f', (chars offset {offset})'
     except ValueError as e:
         logger.exception(e)
@@ -87,32 +153,130 @@ def get_error_caption(bad_text: str, exc_message: str):
         bad_char = offset + 1
         start = bad_char - chars_before
 
-        bad_line = bad_text.replace('\n', ' ')[start:offset + 5]
+        # Slice first: flattening newlines only matters inside the window,
+        # no point in rewriting a copy of the whole message for ~30 chars
+        bad_line = bad_text[start:offset + 5].translate(_NEWLINE_TO_SPACE)
         pointer_line = ' ' * (chars_before - 1) + '^'
-        caption = f':\n\n{pre(bad_line)}\n{code(pointer_line)}'
+        caption = f':\n\n{fast_pre(bad_line)}\n{code(pointer_line)}'
         exc_message += caption
 
     return exc_message
 
 
+# Escaping markdown adds one backslash per one of these symbols,
+# so counting them directly gives the same number as escaping would,
+# without allocating the escaped copy
+MD_SPECIAL_SYMBOLS = LIST_MD_SYMBOLS  # '*_`['
+
+# How many markdown special symbols the entity markup itself adds:
+# *bold*, _italic_, `code` and ```pre``` wrappers
+ENTITY_MD_SYMBOLS = {
+    MessageEntityType.BOLD: 2,
+    MessageEntityType.ITALIC: 2,
+    MessageEntityType.CODE: 2,
+    MessageEntityType.PRE: 6,
+}
+
+
+# Html-quoting adds one '&' per one of these ('&' itself becomes &amp;,
+# which still holds exactly one '&', so it adds nothing)
+HTML_SPECIAL_SYMBOLS = '<>"'
+
+# Every symbol that can affect detection
+MARKUP_SYMBOLS = MD_SPECIAL_SYMBOLS + HTML_SPECIAL_SYMBOLS
+
+
+def is_plain_text(message: Message) -> bool:
+    """
+    True when the message carries no entities and none of the symbols
+    that formatting detection counts — nothing to parse, nothing to escape
+    """
+
+    return not message.entities and not any(symbol in message.text for symbol in MARKUP_SYMBOLS)
+
+
+def count_md_special_symbols(text: str) -> int:
+    return sum(text.count(symbol) for symbol in MD_SPECIAL_SYMBOLS)
+
+
+def count_entities_md_special_symbols(entities: List[MessageEntity]) -> int:
+    """
+    Counts markdown special symbols that rendering entities as [text](url)
+    and friends would add on top of the raw text
+
+    (plain urls are not counted, matching `dont_change_plain_urls`)
+    """
+
+    count = 0
+    for entity in entities:
+        if entity.type in (MessageEntityType.TEXT_LINK, MessageEntityType.TEXT_MENTION):
+            count += 1 + count_md_special_symbols(entity.url or '')
+        else:
+            count += ENTITY_MD_SYMBOLS.get(entity.type, 0)
+    return count
+
+
+# Formatting is detected both on initial send and on each 'Markup' callback
+# for the very same text, so recent results are kept around
+FORMATTING_CACHE_SIZE = 1024
+
+_formatting_cache: 'OrderedDict[tuple, Optional[str]]' = OrderedDict()
+
+
+def _formatting_cache_key(message: Message) -> tuple:
+    return message.chat.id, message.message_id, hash(message.text)
+
+
+_md_text_cache: 'OrderedDict[tuple, str]' = OrderedDict()
+
+
+def get_md_text(message: Message) -> str:
+    """
+    `message.md_text` with plain urls kept as-is
+
+    Rendering walks every entity and escapes every plain chunk, and toggling
+    Markdown <-> Markup re-renders the same text on each round trip,
+    so results are cached the same way detection results are
+    """
+
+    key = _formatting_cache_key(message)
+    try:
+        md_text = _md_text_cache[key]
+    except KeyError:
+        with dont_change_plain_urls:
+            md_text = message.md_text
+        _md_text_cache[key] = md_text
+        if len(_md_text_cache) > FORMATTING_CACHE_SIZE:
+            _md_text_cache.popitem(last=False)
+    else:
+        _md_text_cache.move_to_end(key)
+    return md_text
+
+
 def detect_message_text_formatting(message: Message) -> Optional[str]:
     """
     Detects message formatting
     (html, markdown or None if message has special entities)
     """
 
-    raw_text: str = message.text
-
-    before_escape_md = raw_text.count('\\')
-    before_escape_html = raw_text.count('&')
+    key = _formatting_cache_key(message)
+    try:
+        parse_mode = _formatting_cache[key]
+    except KeyError:
+        pass
+    else:
+        _formatting_cache.move_to_end(key)
+        return parse_mode
 
-    escaped_md = escape_md(raw_text).count('\\') - before_escape_md
-    escaped_html = quote_html(raw_text).count('&') - before_escape_html
+    raw_text: str = message.text
 
-    with dont_change_plain_urls, dont_escape_md:
-        with_entities = message.md_text
+    if is_plain_text(message):
+        # Plain text, the most common case: every count below would be zero
+        return 'markdown'
 
-    escaped_with_entities = escape_md(with_entities).count('\\') - before_escape_md
+    escaped_md = count_md_special_symbols(raw_text)
+    escaped_html = sum(raw_text.count(symbol) for symbol in HTML_SPECIAL_SYMBOLS)
+    escaped_with_entities = escaped_md + count_entities_md_special_symbols(message.entities or ())
 
     if escaped_with_entities > max(escaped_html, escaped_md):
         parse_mode = None
@@ -121,6 +285,10 @@ def detect_message_text_formatting(message: Message) -> Optional[str]:
     else:
         parse_mode = 'markdown'
 
+    _formatting_cache[key] = parse_mode
+    if len(_formatting_cache) > FORMATTING_CACHE_SIZE:
+        _formatting_cache.popitem(last=False)
+
     return parse_mode
 
 
@@ -136,13 +304,23 @@ async def answer_on_message(message: Message):
     Otherwise sends it unchanged
     """
 
+    if is_plain_text(message):
+        # Nothing to parse means the send cannot fail,
+        # so the echo and the delete can safely race
+        bot.parse_mode = 'markdown'
+        await asyncio.gather(
+            bot.send_message(message.chat.id, message.text, reply_markup=SHOW_RAW_MARKUP,
+                             disable_web_page_preview=True),
+            message.delete(),
+        )
+        return
+
     formatting = detect_message_text_formatting(message)
 
     if formatting is None:
         # Message contained special entities
         bot.parse_mode = 'markdown'
-        with dont_change_plain_urls:
-            message_text = message.md_text
+        message_text = get_md_text(message)
     else:
         # Send it with parse mode matching plain text formatting
         bot.parse_mode = formatting
@@ -159,7 +337,7 @@ async def answer_on_message(message: Message):
         await message.delete()
 
 
-@dp.callback_query_handler(lambda q: q.data in (SHOW_RAW_MD, SHOW_RAW_HTML, SHOW_FORMATTED))
+@dp.callback_query_handler(lambda q: q.data in MODIFY_CALLBACKS)
 async def modify_message(query: CallbackQuery):
     """
     That's how `Markup` and `Markdown` buttons work
@@ -175,23 +353,25 @@ async def modify_message(query: CallbackQuery):
     else:
         markup = SHOW_FORMATTED_MARKUP
         to_html = query.data == SHOW_RAW_HTML
-        with dont_change_plain_urls:
-            bot.parse_mode = 'html' if to_html else 'markdown'  # https://github.com/aiogram/aiogram/pull/205/
-            new_text = message.html_text if to_html else message.md_text
+        bot.parse_mode = 'html' if to_html else 'markdown'  # https://github.com/aiogram/aiogram/pull/205/
+        if to_html:
+            with dont_change_plain_urls:
+                new_text = message.html_text
+        else:
+            new_text = get_md_text(message)
         bot.parse_mode = None
 
-    answer_callback = asyncio.create_task(query.answer())  # remove 'Loading...' on user side quickly
-
     try:
-        await message.edit_text(new_text, disable_web_page_preview=True, reply_markup=markup)
+        # query.answer() removes 'Loading...' on user side
+        # while the edit is still in flight
+        await asyncio.gather(
+            message.edit_text(new_text, disable_web_page_preview=True, reply_markup=markup),
+            query.answer(),
+        )
     except CantParseEntities as e:
-        answer_callback.cancel()
         await query.answer(str(e), show_alert=True)
     except MessageNotModified:
-        answer_callback.cancel()
         await query.answer('Message has no formatting')
-    else:
-        await answer_callback
 
 
 @dp.errors_handler()
@@ -199,5 +379,8 @@ async def handle_errors(update: Update, exception):
     message = update.message or update.callback_query.message
     if message is None:
         return
+    key = _formatting_cache_key(message)
+    _formatting_cache.pop(key, None)
+    _md_text_cache.pop(key, None)
     await message.bot.send_message(message.chat.id, 'Oops... Something went wrong here.')
     logger.exception(exception)